@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-# pylint: disable=import-outside-toplevel, logging-fstring-interpolation
 
 """ Reads gas meter pulses and sends them to MQTT broker used by HomA framework. """
 
@@ -13,17 +12,29 @@
 # 2026/01/11 Refacored use of global variables to function attributes, fixed debounce handling
 # 2026/01/15 Added suggested_display_precision to Home Assistant discovery config messages
 # 2026/01/25 Replaced deprecated object_id by default_entity_id in homeassistant_config
+# 2026/10/15 Run MQTT client and GPIO edge detection on a single asyncio event loop
+# 2026/10/15 Moved pulse counter state from function attributes to GasMeterState
 
 import argparse
+import asyncio
 from datetime import timedelta
 import sys
 import json
+import selectors
 import os.path
 import time
 import ssl
 # import RPi.GPIO as GPIO
+try:
+    import gpiod
+    from gpiod.line import Bias, Clock, Direction, Edge
+except ImportError:  # pragma: no cover - gpiod is only available on the target system
+    gpiod = None
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.subscribeoptions import SubscribeOptions
 import addon  # provides logging like bashio, provides Home Assistant / MQTT broker config
 
 
@@ -43,17 +54,55 @@ INIT_FILE = "/dev/shm/homa_init."+ systemId
 GPIO_CHIP = "/dev/gpiochip0"
 RESOLUTION = 0.01 # m^3 / pulse
 DEBOUNCE_MS = 1000 # debounce time [ms]
+LITRES_PER_PULSE = round(RESOLUTION * 1000)  # l / pulse, pulse values are calculated in 1/1000 units
+ENERGY_SCALE = round(calorific_value * 1_000_000)  # mWh/m^3, keeps all decimals of calorific_value given on gas bills
+FLOW_CONST = LITRES_PER_PULSE * 3_600_000  # l * ms/h, flow rate [l/h] = FLOW_CONST / pulse interval [ms]
+SCHED_PRIORITY = 10  # SCHED_FIFO priority while waiting for pulses (needs CAP_SYS_NICE)
+NICE_INCREMENT = -10  # fallback if SCHED_FIFO is not available
+MQTT_KEEPALIVE = 300  # MQTT keepalive interval [s]
+RECONNECT_MIN_DELAY = 1  # first MQTT reconnect delay, doubled on every failed attempt [s]
+RECONNECT_MAX_DELAY = 16  # maximum MQTT reconnect delay [s]
+CONNECT_TIMEOUT = 10  # maximum time to wait for the first MQTT connection [s]
+EXPIRY_S = 3600  # message expiry interval of not retained pulse values [s]
 
 T_VOLUME = "Volume"
 T_ENERGY = "Energy"
 T_FLOW_RATE = "Flow rate"
 T_TIMESTAMP = "Timestamp"
 # config components control room name (if wanted) here
-mqtt_arr = [
-    {'topic': T_VOLUME,    'room': 'Home', 'unit': ' m³',   'precision': 2, 'class': 'gas'},
-    {'topic': T_ENERGY,    'room': '',     'unit': ' kWh',  'precision': 2, 'class': 'energy'},
-    {'topic': T_FLOW_RATE, 'room': '',     'unit': ' m³/h', 'precision': 3, 'class': 'volume_flow_rate'},
-    {'topic': T_TIMESTAMP, 'room': '',     'unit': '',      'class': '_datetime'}]
+# (keyed by control topic, the insertion order defines the HomA control order)
+mqtt_arr = {
+    T_VOLUME:    {'room': 'Home', 'unit': ' m³',   'precision': 2, 'class': 'gas'},
+    T_ENERGY:    {'room': '',     'unit': ' kWh',  'precision': 2, 'class': 'energy'},
+    T_FLOW_RATE: {'room': '',     'unit': ' m³/h', 'precision': 3, 'class': 'volume_flow_rate'},
+    T_TIMESTAMP: {'room': '',     'unit': '',      'class': '_datetime'}}
+# precompute control and Home Assistant discovery topics once, they are constant at runtime
+_TOPICS = {topic: f"/devices/{systemId}/controls/{topic}" for topic in mqtt_arr}
+_OBJECT_IDS = {topic: f"{systemId}-{topic.replace(' ', '-')}" for topic in mqtt_arr}
+_HA_TOPICS = {topic: f"homeassistant/sensor/{object_id}/config" for topic, object_id in _OBJECT_IDS.items()}
+# MQTT v5 publish properties for values that only need to be known for a while (not retained)
+_EXPIRY_PROPS = Properties(PacketTypes.PUBLISH)
+_EXPIRY_PROPS.MessageExpiryInterval = EXPIRY_S
+# Home Assistant gets all pulse values together as JSON on one state topic
+_STATE_TOPIC = f"/devices/{systemId}/state"
+# Home Assistant device shared by all discovery config messages
+_DEVICE_DICT = {
+    "identifiers":[systemId],
+    "name":device_name,
+    "manufacturer":"Holger Müller",
+    "model":"Raspberry Pi 5 Gas Meter Module",
+    "suggested_area":area
+}
+
+
+class GasMeterState:
+    """Pulse counter state, slots avoid a dict lookup per attribute access."""
+    __slots__ = ('gas_counter', 'ts_last_ms', 'ts_edge_ms')
+
+    def __init__(self):
+        self.gas_counter = 0  # counter of gas amount [ticks per RESOLUTION]
+        self.ts_last_ms = 0  # time of last pulse send to broker [ms]
+        self.ts_edge_ms = 0  # time of last rising edge, used for debounce [ms]
 
 
 def get_topic(t1 = None, t2 = None, t3 = None) -> str:
@@ -68,56 +117,52 @@ def get_topic(t1 = None, t2 = None, t3 = None) -> str:
         topic += "/"+ t2
     if t3:
         topic += "/"+ t3
-    addon.log.debug("get_topic(): '%s'", topic)
     return topic
 
 
+def publish_retained(msgs):
+    """Publish (topic, payload) tuples as retained messages, a payload of None removes the retained message."""
+    for topic, payload in msgs:
+        mqttc.publish(topic, payload, retain=True)
+
+
 def homa_init():
     "Publish HomA setup messages to MQTT broker."
-    # check if we need to init HomA
-    if os.path.isfile(INIT_FILE):
-        addon.log.info(f"{PY_FILE} HomA setup data not reloaded, to do so delete {INIT_FILE} and restart.")
-        return
-    addon.log.info(f"{PY_FILE} Publishing HomA setup data ...")
-    # set room name
-    mqttc.publish(get_topic("meta/room"), room, retain=True)
-    # set device name
-    mqttc.publish(get_topic("meta/name"), device_name, retain=True)
-    # setup controls
-    order = 1
-    for mqtt_item in mqtt_arr:
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/type"), "text", retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/order"), order, retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/unit"), mqtt_item['unit'], retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/room"), mqtt_item['room'], retain=True)
-        homeassistant_config(mqtt_item)
-        order += 1
-    # create init file (do not fail if not writable)
+    # check if we need to init HomA by creating the init file (do not fail if not writable)
     try:
-        with open(INIT_FILE, 'w', encoding="utf-8"):
-            pass
+        os.close(os.open(INIT_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+    except FileExistsError:
+        addon.log.info("%s HomA setup data not reloaded, to do so delete %s and restart.", PY_FILE, INIT_FILE)
+        return
     except OSError as exc:  # pragma: no cover - environment dependent
         addon.log.warning("Could not create HomA init file %s: %s", INIT_FILE, exc)
-
-
-def homeassistant_config(mqtt_item):
+    addon.log.info("%s Publishing HomA setup data ...", PY_FILE)
+    msgs = [(get_topic("meta/room"), room), (get_topic("meta/name"), device_name)]  # set room and device name
+    # setup controls
+    for order, (topic, mqtt_item) in enumerate(mqtt_arr.items(), start=1):
+        control_topic = _TOPICS[topic]
+        msgs += [(control_topic + "/meta/type", "text"),
+                 (control_topic + "/meta/order", order),
+                 (control_topic + "/meta/unit", mqtt_item['unit']),
+                 (control_topic + "/meta/room", mqtt_item['room'])]
+    publish_retained(msgs)
+    for topic, mqtt_item in mqtt_arr.items():
+        homeassistant_config(topic, mqtt_item)
+
+
+def homeassistant_config(control, mqtt_item):
     """Send the Home Assistant config messages to enable discovery"""
     if 'class' not in mqtt_item:
         return
-    object_id = systemId+"-"+mqtt_item['topic'].replace(" ", "-")
+    object_id = _OBJECT_IDS[control]
     payload = {
         "device_class":mqtt_item['class'],
-        "state_topic":"/devices/"+systemId+"/controls/"+mqtt_item['topic'],
-        "name":mqtt_item['topic'],
+        "state_topic":_STATE_TOPIC,
+        "name":control,
         "unique_id":object_id,
         "default_entity_id":object_id,
-        "device":{
-            "identifiers":[systemId],
-            "name":device_name,
-            "manufacturer":"Holger Müller",
-            "model":"Raspberry Pi 5 Gas Meter Module",
-            "suggested_area":area
-        }
+        "value_template":f"{{{{ value_json['{control}'] }}}}",
+        "device":_DEVICE_DICT
     }
     if mqtt_item['class'] in ["temperature", "power_factor"]:
         payload['state_class'] = "measurement"
@@ -130,7 +175,7 @@ def homeassistant_config(mqtt_item):
     # special treatment for _datetime
     if mqtt_item['class'] == "_datetime":
         del payload['device_class']
-        payload['value_template'] = "{{ as_datetime(value) }}"
+        payload['value_template'] = f"{{{{ as_datetime(value_json['{control}']) }}}}"
         payload['icon'] = "mdi:calendar-arrow-right"
     # set suggested_display_precision only if available
     if 'precision' in mqtt_item and isinstance(mqtt_item['precision'], int):
@@ -141,43 +186,50 @@ def homeassistant_config(mqtt_item):
     # set value_template only if available
     if 'template' in mqtt_item:
         payload['value_template'] = mqtt_item['template']
-    topic = "homeassistant/sensor/"+object_id+"/config"
-    mqttc.publish(topic, json.dumps(payload), retain=True)
-    addon.log.debug(f"Published HA config {topic}: {json.dumps(payload)}")
+    topic = _HA_TOPICS[control]
+    payload_json = json.dumps(payload, separators=(',', ':'))
+    mqttc.publish(topic, payload_json, retain=True)
+    addon.log.debug("Published HA config %s: %s", topic, payload_json)
 
 
 def homa_remove():
     """Remove HomA messages from MQTT broker."""
-    addon.log.info(f"Removing HomA / Home Assistant data (systemId {systemId}) ...")
-    mqttc.publish(get_topic("meta/room"), "", retain=True)
-    mqttc.publish(get_topic("meta/name"), "", retain=True)
-    for mqtt_item in mqtt_arr:
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/type"), "", retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/order"), "", retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/unit"), "", retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic'], "meta/room"), "", retain=True)
-        mqttc.publish(get_topic("controls", mqtt_item['topic']), "", retain=True)
-        object_id = systemId+"-"+mqtt_item['topic'].replace(" ", "-")
-        mqttc.publish("homeassistant/sensor/"+object_id+"/config", "", retain=True)
+    addon.log.info("Removing HomA / Home Assistant data (systemId %s) ...", systemId)
+    topics = [get_topic("meta/room"), get_topic("meta/name"), _STATE_TOPIC]
+    topics += [f"{control_topic}/meta/{meta}" for control_topic in _TOPICS.values() for meta in ("type", "order", "unit", "room")]
+    topics += [*_TOPICS.values(), *_HA_TOPICS.values()]
+    publish_retained((topic, None) for topic in topics)
 
 
 def on_connect(client, userdata, flags, reason_code, properties):  # pylint: disable=unused-argument
     """The callback for when the client receives a CONNACK response from the broker."""
     addon.log.debug("on_connect(): Connected with result code %s", str(reason_code))
+    if reason_code.is_failure:
+        addon.log.error("MQTT connection refused: %s", reason_code)
+        return
+    mqtt_connected.set()
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe(get_topic("controls", T_VOLUME))
+    # the retained Volume restores the counter, do not get our own pulse messages back
+    client.subscribe(_TOPICS[T_VOLUME], options=SubscribeOptions(qos=0, noLocal=True))
 
 
 def on_message(client, userdata, msg):  # pylint: disable=unused-argument
     """The callback for when a PUBLISH message is received from the broker."""
-    payload_str = msg.payload.decode("utf-8")  # payload is bytes since API version 2
-    addon.log.debug("on_message(): "+ msg.topic+ ": "+ payload_str)
-    if msg.topic == get_topic("controls", T_VOLUME):
+    if msg.topic != _TOPICS[T_VOLUME]:
+        return
+    try:
+        payload_str = msg.payload.decode("utf-8")  # payload is bytes since API version 2
+        addon.log.debug("on_message(): %s: %s", msg.topic, payload_str)
+        if not payload_str:
+            return  # retained message has been removed
         new_gas_counter = round(float(payload_str) / RESOLUTION)
-        if abs(gas_meter_count.gas_counter - new_gas_counter) > 0:
-            addon.log.warning(f"Setting new gas_counter: {new_gas_counter} which differs from current ({gas_meter_count.gas_counter})")
-            gas_meter_count.gas_counter = new_gas_counter
+    except (UnicodeDecodeError, ValueError, OverflowError) as exc:
+        addon.log.warning("Ignoring invalid message on %s: %r (%s)", msg.topic, msg.payload, exc)
+        return
+    if abs(gas_meter_state.gas_counter - new_gas_counter) > 0:
+        addon.log.warning("Setting new gas_counter: %d which differs from current (%d)", new_gas_counter, gas_meter_state.gas_counter)
+        gas_meter_state.gas_counter = new_gas_counter
 
 
 def on_publish(client, userdata, mid, reason_code, properties):  # pylint: disable=unused-argument
@@ -185,37 +237,127 @@ def on_publish(client, userdata, mid, reason_code, properties):  # pylint: disab
     # addon.log.debug("on_publish(): message send %s", str(mid))
 
 
+def on_socket_open(client, userdata, sock):  # pylint: disable=unused-argument
+    """The callback for when the MQTT socket is opened, reads are driven by the asyncio event loop."""
+    asyncio.get_running_loop().add_reader(sock, mqtt_read, client, sock)
+
+
+def mqtt_read(client, sock):
+    """Read from the MQTT socket, including data already decrypted by TLS the event loop can not see."""
+    client.loop_read()
+    while isinstance(sock, ssl.SSLSocket) and sock.fileno() != -1 and sock.pending():
+        client.loop_read()
+
+
+def on_socket_close(client, userdata, sock):  # pylint: disable=unused-argument
+    """The callback for when the MQTT socket is about to be closed."""
+    asyncio.get_running_loop().remove_reader(sock)
+
+
+def on_socket_register_write(client, userdata, sock):  # pylint: disable=unused-argument
+    """The callback for when the MQTT client has data to write, writes are driven by the asyncio event loop."""
+    asyncio.get_running_loop().add_writer(sock, client.loop_write)
+
+
+def on_socket_unregister_write(client, userdata, sock):  # pylint: disable=unused-argument
+    """The callback for when the MQTT client has no more data to write."""
+    asyncio.get_running_loop().remove_writer(sock)
+
+
+async def mqtt_misc_loop():
+    """Handle MQTT keepalive and reconnects, as there is no paho network thread doing it."""
+    delay = RECONNECT_MIN_DELAY
+    while True:
+        if mqttc.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+            addon.log.info("Reconnecting to MQTT broker %s:%s ...", addon.mqtt_host, addon.mqtt_port)
+            try:
+                mqttc.reconnect()
+            except OSError as exc:
+                addon.log.warning("MQTT reconnect failed, retrying in %d s: %s", delay, exc)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        else:
+            if mqttc.is_connected():
+                delay = RECONNECT_MIN_DELAY
+            await asyncio.sleep(1)
+
+
+async def mqtt_flush():
+    """Wait until all queued MQTT packets have been written to the broker."""
+    while mqttc.socket() is not None and mqttc.want_write():
+        await asyncio.sleep(0.1)
+
+
 def gas_meter_count(ts_ms: int):
     """
     Count gas meter pulse and send to MQTT broker.
     ts: timestamp in ms
     """
 
+    st = gas_meter_state
     timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    gas_meter_count.gas_counter += 1
-    volume = round(gas_meter_count.gas_counter * RESOLUTION, 3)  # do limit precision 3 digits after dot
-    energy = round(volume * calorific_value, 3)  # do limit precision 3 digits after dot
-    if gas_meter_count.ts_last_ms == 0:
-        rate = 0.0
+    st.gas_counter += 1
+    # integer arithmetic in 1/1000 units, so values have at most 3 digits after dot
+    volume_l = st.gas_counter * LITRES_PER_PULSE  # [l] = [m^3 / 1000]
+    energy_wh = (volume_l * ENERGY_SCALE + 500_000) // 1_000_000  # [Wh] = [kWh / 1000]
+    if st.ts_last_ms == 0:
+        rate_lph = 0
     else:
-        rate = round(RESOLUTION / (ts_ms - gas_meter_count.ts_last_ms) * 1000 * 3600, 3)  # do limit precision 3 digits after dot
-    gas_meter_count.ts_last_ms = ts_ms
-    mqttc.publish(get_topic("controls", T_VOLUME), volume, retain=True)
-    mqttc.publish(get_topic("controls", T_ENERGY), energy, retain=True)
-    mqttc.publish(get_topic("controls", T_FLOW_RATE), rate, retain=True)
-    mqttc.publish(get_topic("controls", T_TIMESTAMP), timestamp, retain=True)
-    addon.log.debug(f"Rising edge detected. gas_counter = {gas_meter_count.gas_counter}, volume = {volume} m³")
+        dt_ms = ts_ms - st.ts_last_ms
+        rate_lph = (FLOW_CONST + dt_ms // 2) // dt_ms  # [l/h] = [m^3/h / 1000]
+    st.ts_last_ms = ts_ms
+    state = {
+        T_VOLUME:volume_l / 1000,
+        T_ENERGY:energy_wh / 1000,
+        T_FLOW_RATE:rate_lph / 1000,
+        T_TIMESTAMP:timestamp
+    }
+    # HomA reads the control topics
+    mqttc.publish(_TOPICS[T_VOLUME], f"{state[T_VOLUME]:.3f}", retain=True)
+    mqttc.publish(_TOPICS[T_ENERGY], f"{state[T_ENERGY]:.3f}", retain=True)
+    mqttc.publish(_TOPICS[T_FLOW_RATE], f"{state[T_FLOW_RATE]:.3f}", qos=1, properties=_EXPIRY_PROPS)
+    mqttc.publish(_TOPICS[T_TIMESTAMP], timestamp, qos=1, properties=_EXPIRY_PROPS)
+    # Home Assistant reads all values from one message
+    mqttc.publish(_STATE_TOPIC, json.dumps(state, separators=(',', ':')), retain=True)
+    addon.log.debug("Rising edge detected. gas_counter = %d, volume = %.3f m³", st.gas_counter, state[T_VOLUME])
+
+
+def gas_meter_read(request):
+    """Read gas meter pulses from the GPIO line request, called by the event loop if events are pending."""
+    # only rising edges of gpio_pin are requested, so every event is an impulse
+    for event in request.read_edge_events():
+        # debounce
+        ts_ms = event.timestamp_ns // 1_000_000
+        if ts_ms - gas_meter_state.ts_edge_ms < DEBOUNCE_MS:
+            addon.log.debug("Debounce: Ignored pulse at %d ms, last at %d ms", ts_ms, gas_meter_state.ts_edge_ms)
+            gas_meter_state.ts_edge_ms = ts_ms
+            continue
+        gas_meter_count(ts_ms)
+        gas_meter_state.ts_edge_ms = ts_ms
+
+
+def set_realtime_priority():
+    """Raise the process priority to reduce the latency of GPIO edge event wakeups."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(SCHED_PRIORITY))
+        addon.log.info("%s Using SCHED_FIFO scheduling with priority %d", PY_FILE, SCHED_PRIORITY)
+    except PermissionError:
+        try:
+            os.nice(NICE_INCREMENT)
+            addon.log.info("%s SCHED_FIFO not permitted, using nice %d", PY_FILE, NICE_INCREMENT)
+        except PermissionError as exc:
+            addon.log.warning("Could not raise process priority (CAP_SYS_NICE missing?): %s", exc)
 
 
-def gas_meter_wait():
+async def gas_meter_wait():
     """Wait for gas meter pulses and send them to MQTT broker."""
-    import gpiod
-    from gpiod.line import Direction, Edge, Bias
-    from gpiod.edge_event import EdgeEvent
+    if gpiod is None:
+        addon.log.error("%s gpiod module not available, can not read gas meter pulses.", PY_FILE)
+        sys.exit(1)
 
     with gpiod.Chip(GPIO_CHIP) as chip:
         info = chip.get_info()
-        addon.log.info(f"{PY_FILE} Using {info.name} [{info.label}] ({info.num_lines} lines)")
+        addon.log.info("%s Using %s [%s] (%d lines)", PY_FILE, info.name, info.label, info.num_lines)
 
     with gpiod.request_lines(
         GPIO_CHIP,
@@ -224,29 +366,19 @@ def gas_meter_wait():
             gpio_pin: gpiod.LineSettings(
                 direction=Direction.INPUT,
                 edge_detection=Edge.RISING,
-                debounce_period=timedelta(milliseconds=100),
+                debounce_period=timedelta(milliseconds=100),  # glitch filter only, pulses are debounced by DEBOUNCE_MS
+                event_clock=Clock.MONOTONIC,  # flow rate must not jump with the wall clock
                 bias=Bias.PULL_UP
             )
         },
     ) as request:
-        addon.log.info(f"{PY_FILE} Started – waiting for pulses ...")
-        while True:
-            # blocks until at least one event arrives
-            request.wait_edge_events(timeout=5_000)  # 5 sec timeout
-            events = request.read_edge_events()
-            for event in events:
-                # raising edge = impulse
-                if event.line_offset == gpio_pin and event.event_type == EdgeEvent.Type.RISING_EDGE:
-                    # debounce
-                    ts_ms = event.timestamp_ns // 1_000_000
-                    if ts_ms - gas_meter_wait.ts_last_ms < DEBOUNCE_MS:
-                        addon.log.debug(f"Debounce: Ignored pulse on line {event.line_offset} at {ts_ms} ms, last at {gas_meter_wait.ts_last_ms} ms")
-                        gas_meter_wait.ts_last_ms = ts_ms
-                        continue
-                    gas_meter_count(ts_ms)
-                    gas_meter_wait.ts_last_ms = ts_ms
-                else:
-                    addon.log.error(f"Unexpected event type {event.event_type} on line {event.line_offset}, expected {EdgeEvent.Type.RISING_EDGE} on {gpio_pin}")
+        loop = asyncio.get_running_loop()
+        loop.add_reader(request.fd, gas_meter_read, request)
+        addon.log.info("%s Started – waiting for pulses ...", PY_FILE)
+        try:
+            await asyncio.Future()  # pulses are handled by gas_meter_read() until cancelled
+        finally:
+            loop.remove_reader(request.fd)
 
 
 def parse_args():
@@ -260,10 +392,38 @@ def parse_args():
     return parser.parse_args()
 
 
+def epoll_event_loop() -> asyncio.AbstractEventLoop:
+    """Create the event loop, GPIO request fd and MQTT socket are waited for by a single epoll instance."""
+    return asyncio.SelectorEventLoop(selectors.EpollSelector())
+
+
+async def main():
+    """Connect to the MQTT broker and run HomA setup / removal and the pulse counter."""
+    mqttc.connect(addon.mqtt_host, port=addon.mqtt_port, keepalive=MQTT_KEEPALIVE)
+    misc_task = asyncio.create_task(mqtt_misc_loop())
+    try:
+        try:
+            await asyncio.wait_for(mqtt_connected.wait(), timeout=CONNECT_TIMEOUT)
+        except TimeoutError:
+            addon.log.error("%s MQTT connect timeout (%s:%s)", PY_FILE, addon.mqtt_host, addon.mqtt_port)
+            sys.exit(1)
+        if args.r:
+            homa_remove()  # remove HomA MQTT device and control settings
+        else:
+            homa_init()  # setup MQTT device and control settings
+            set_realtime_priority()
+            await gas_meter_wait()  # wait for gas meter pulses (runs until cancelled)
+    finally:
+        # wait until all queued topics are published
+        misc_task.cancel()
+        await mqtt_flush()
+        mqttc.disconnect()
+        await mqtt_flush()
+
+
 # main program
-gas_meter_count.gas_counter = 0  # counter of gas amount [ticks per RESOLUTION]
-gas_meter_count.ts_last_ms = 0  # time of last pulse send to broker [ms]
-gas_meter_wait.ts_last_ms = 0  # time of last debounced pulse [ms]
+gas_meter_state = GasMeterState()
+mqtt_connected = asyncio.Event()  # set by on_connect() if the broker accepted the connection
 args = parse_args()
 if args.d:
     debug = True
@@ -278,23 +438,22 @@ if args.brokerPort is not None:
     addon.mqtt_port = args.brokerPort
 
 # connect to MQTT broker
-mqttc = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2)
+mqttc = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
 mqttc.on_connect = on_connect
 mqttc.on_message = on_message
 mqttc.on_publish = on_publish
+mqttc.on_socket_open = on_socket_open
+mqttc.on_socket_close = on_socket_close
+mqttc.on_socket_register_write = on_socket_register_write
+mqttc.on_socket_unregister_write = on_socket_unregister_write
 if addon.mqtt_ca_certs != "":
+    tls_context = ssl.create_default_context(cafile=addon.mqtt_ca_certs)
+    tls_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    mqttc.tls_set_context(tls_context)
     #mqttc.tls_insecure_set(True) # Do not use this "True" in production!
-    mqttc.tls_set(addon.mqtt_ca_certs, certfile=None, keyfile=None, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
 mqttc.username_pw_set(addon.mqtt_user, password=addon.mqtt_pwd)
-mqttc.connect(addon.mqtt_host, port=addon.mqtt_port)
-mqttc.loop_start()
-time.sleep(1)  # wait for connection setup
-
-if args.r:
-    homa_remove()  # remove HomA MQTT device and control settings
-else:
-    homa_init()  # setup MQTT device and control settings
-    gas_meter_wait()  # wait for gas meter pulses (blocking)
+with asyncio.Runner(loop_factory=epoll_event_loop) as runner:
+    runner.run(main())
 
 # configure GPIO
 # GPIO.setmode(GPIO.BCM)
@@ -318,7 +477,3 @@ else:
 #         addon.log.info('\nKeyboardInterrupt. Stopping program.')
 #         GPIO.cleanup() # clean up GPIO on CTRL+C exit
 #         break
-
-# wait until all queued topics are published
-mqttc.loop_stop()
-mqttc.disconnect()